@@ -2,16 +2,116 @@
 Oliver 2024
 """
 
+import concurrent.futures
+import contextlib
 import csv as _csv
+import functools
+import hashlib
+import itertools
 import json
 import os.path as _op
+import pathlib
 import re
-import sqlite3 as sqlite
+try:
+    # pysqlite3-binary ships a newer sqlite than many system pythons link against
+    from pysqlite3 import dbapi2 as sqlite
+except ImportError:
+    import sqlite3 as sqlite
+import threading
+import time
+import weakref
 from typing import Dict, List, Any, Tuple, Callable
 import sqlite_vec
 from . import utils
 
+try:
+    import vectorlite_py
+except ImportError:  # optional, hnsw indexes fall back to vec0
+    vectorlite_py = None
+
+try:
+    import pyarrow as _pa
+    import pyarrow.csv as _pacsv
+except ImportError:  # optional, csv files are parsed with the csv module
+    _pa = _pacsv = None
+
 IN_MEMORY = ":memory:"
+# errors of a failed csv load, pyarrow's reader raises its own once streaming has started
+_CSV_ERRORS = (sqlite.Error,) if _pa is None else (sqlite.Error, _pa.ArrowInvalid, UnicodeDecodeError)
+
+# statements that can change the set of tables or their columns
+_DDL_RE = re.compile(r"\b(?:CREATE|DROP|ALTER)\b", flags=re.IGNORECASE)
+# temporary objects only exist on the connection that created them,
+# CREATE TEMP ... or CREATE TABLE temp.name at the start of a statement
+_TEMP_RE = re.compile(
+    r"(?:^|;)\s*CREATE\s+(?:TEMP(?:ORARY)?\b|(?:UNIQUE\s+)?(?:TABLE|VIEW|INDEX|TRIGGER)\s+"
+    r"(?:IF\s+NOT\s+EXISTS\s+)?TEMP\s*\.)",
+    flags=re.IGNORECASE
+)
+# attached databases only exist on the connection that attached them
+_ATTACH_RE = re.compile(r"(?:^|;)\s*ATTACH\b", flags=re.IGNORECASE)
+# plain reads that can be served by the read-only connection
+_SELECT_RE = re.compile(r"\s*SELECT\b", flags=re.IGNORECASE)
+# functions reporting on the writes of the connection they run on
+_CONN_STATE_RE = re.compile(r"\b(?:last_insert_rowid|changes|total_changes)\s*\(", flags=re.IGNORECASE)
+# statements limited to a single row, fetched as one object
+_LIMIT1_RE = re.compile(r" LIMIT 1(?=[\s;])", flags=re.IGNORECASE)
+# module of a virtual table definition, e.g. vec0 or vectorlite
+_USING_RE = re.compile(r"\bUSING\s+(\w+)", flags=re.IGNORECASE)
+# int8 quantized embedding column of a vector table
+_INT8_RE = re.compile(r"\bembedding\s+int8\b", flags=re.IGNORECASE)
+# upper bound of entries kept by the opt-in query result cache
+_QUERY_CACHE_SIZE = 1024
+# upper bound of texts whose serialized embeddings are kept
+_EMBED_CACHE_SIZE = 4096
+# texts longer than this are cached under their digest rather than kept whole
+_EMBED_KEY_MAX_LEN = 256
+
+
+def _copy_result(result: Any) -> Any:
+    """
+    a copy of a cached fetch result, so callers mutating theirs
+    (e.g. sorting a list) don't change what later calls get
+    :param result: fetch result
+    :return: copy of lists and dictionaries, tuples and scalars as they are
+    """
+    if isinstance(result, list):
+        return [dict(r) if isinstance(r, dict) else r for r in result]
+    if isinstance(result, dict):
+        return dict(result)
+    return result
+
+
+def _split_script(script: str) -> List[str]:
+    """
+    splits an sql script into its statements, semicolons inside
+    literals or trigger bodies don't end a statement
+    :param script: sql script
+    :return: list of statements
+    """
+    statements = []
+    current = ""
+    for piece in script.split(";"):
+        current += piece + ";"
+        if sqlite.complete_statement(current):
+            if current.strip(" \t\r\n;"):
+                statements.append(current)
+            current = ""
+    if current.strip(" \t\r\n;"):
+        statements.append(current[:-1])
+    return statements
+
+
+def _embed_key(text: str) -> str | bytes:
+    """
+    the embedding cache key of a text, large texts are keyed on their
+    blake2b digest so the cache doesn't keep thousands of documents alive
+    :param text: text of the embedding
+    :return: the text itself when short, otherwise its 16 byte digest
+    """
+    if len(text) <= _EMBED_KEY_MAX_LEN:
+        return text
+    return hashlib.blake2b(text.encode("utf-8", "surrogatepass"), digest_size=16).digest()
 
 
 def echo_callback(stmt):
@@ -22,6 +122,132 @@ def progress_callback(status, remaining, total):
     print("{}/{} pages copied..".format(total - remaining, total))
 
 
+@functools.lru_cache(maxsize=256)
+def _compose_select(table_name: str, columns: Tuple[str, ...] | None, distinct: bool, where: str | None,
+                    group_by: str | None, having: str | None, order_by: str | None, asc: bool,
+                    paged: bool) -> str:
+    """
+    builds the sql text of a select statement, memoized since
+    the same statement is usually rebuilt on every call.
+    limit and offset are left as parameters so the text stays
+    the same across pages and hits sqlite's statement cache,
+    unpaged selects get no LIMIT clause at all
+    :return: select statement
+    """
+    col_list = ",".join(columns) if columns else "*"
+    # only present clauses are appended, no empty fragments are built
+    parts = [f"SELECT {'DISTINCT ' if distinct else ''}{col_list} FROM {table_name}"]
+    if where:
+        parts.append(f"WHERE {where}")
+    if group_by:
+        parts.append(f"GROUP BY {group_by}")
+    if having:
+        parts.append(f"HAVING {having}")
+    if order_by:
+        parts.append(f"ORDER BY {order_by} {'ASC' if asc else 'DESC'}")
+    if paged:
+        parts.append("LIMIT ? OFFSET ?")
+    return ' '.join(parts) + ';'
+
+
+@functools.lru_cache(maxsize=256)
+def _compose_insert(table_name: str, columns: Tuple[str, ...], replace: bool, returning: str | None) -> str:
+    """
+    builds the sql text of a parameterized insert statement
+    :return: insert statement
+    """
+    core = "INSERT INTO" if not replace else "INSERT OR REPLACE INTO"
+    col_list = ','.join(columns)
+    val_list = ','.join(['?' for _ in columns])
+    return f"{core} {table_name} ({col_list}) VALUES ({val_list}){' RETURNING %s' % returning if returning else ''};"
+
+
+@functools.lru_cache(maxsize=256)
+def _compose_update(table_name: str, columns: Tuple[str, ...], where: str, returning: str | None) -> str:
+    """
+    builds the sql text of a parameterized update statement
+    :return: update statement
+    """
+    params = ', '.join([f"{c} = ?" for c in columns])
+    return f"UPDATE {table_name} SET {params} WHERE {where}{' RETURNING %s' % returning if returning else ''};"
+
+
+@functools.lru_cache(maxsize=256)
+def _compose_delete(table_name: str, where: str, returning: str | None) -> str:
+    """
+    builds the sql text of a delete statement
+    :return: delete statement
+    """
+    return f"DELETE FROM {table_name} WHERE {where}{' RETURNING %s' % returning if returning else ''};"
+
+
+def _iter_csv_arrow(filepath: str, chunk_size: int = 10_000):
+    """
+    reads a csv file a chunk of rows at a time with pyarrow's streaming reader,
+    every field is read as text (empty fields stay empty strings) so rows match utils.iter_csv.
+    the first block is parsed before returning, so a file arrow can't read fails here
+    :param filepath: path to csv file
+    :param chunk_size: max number of rows per chunk
+    :return: generator of tuples of header list and list of rows, or None for an empty file
+    """
+    headers = utils.read_csv_header(filepath)
+    if not headers:
+        return None
+    reader = _pacsv.open_csv(
+        filepath,
+        read_options=_pacsv.ReadOptions(column_names=headers, skip_rows=1),
+        # quoted fields may span lines like they can for the csv module, blank lines are skipped
+        parse_options=_pacsv.ParseOptions(newlines_in_values=True),
+        convert_options=_pacsv.ConvertOptions(
+            column_types={h: _pa.string() for h in headers}, strings_can_be_null=False
+        ),
+    )
+
+    def chunks():
+        rows = itertools.chain.from_iterable(
+            zip(*(col.to_pylist() for col in batch.columns)) for batch in reader
+        )
+        chunk = list(itertools.islice(rows, chunk_size))
+        yield headers, chunk
+        while len(chunk) == chunk_size:
+            chunk = list(itertools.islice(rows, chunk_size))
+            if chunk:
+                yield headers, chunk
+
+    return chunks()
+
+
+@functools.lru_cache(maxsize=256)
+def _compose_aggregate(table_name: str, column: str, agg: str) -> str:
+    """
+    builds the sql text of an aggregate over a single column
+    :return: aggregate statement
+    """
+    return f"SELECT {agg}({column}) FROM {table_name};"
+
+
+class _ConnectionState:
+    """a connection together with its pooled cursor"""
+
+    def __init__(self, con: sqlite.Connection, shared: bool):
+        """
+        :param con: sqlite connection
+        :param shared: flag of whether the connection may be used by several threads
+        """
+        self.con: sqlite.Connection = con
+        self.shared: bool = shared
+        # long-lived tuple cursor reused by fetch/execute so no cursor is allocated
+        # per call and the connection's row_factory is never mutated
+        self.cur_tuple: sqlite.Cursor = con.cursor()
+        # the pooled cursor is not thread-safe, serialize access to it
+        # when the connection is allowed to leave its creating thread
+        self.lock = threading.RLock() if shared else contextlib.nullcontext()
+        # set while a transaction() block is open so statements don't commit on their own
+        self.in_txn: bool = False
+        # read-only connection for plain selects
+        self.reader: _ConnectionState | None = None
+
+
 class SQRL:
     def __init__(
             self,
@@ -31,11 +257,13 @@ class SQRL:
             detect_types: int = 0,
             isolation_level: str | None = None,
             check_same_thread: bool = True,
-            cached_statements: int = 128,
+            cached_statements: int = 512,
             optimize: bool = True,
             foreign_keys: bool = True,
             enable_vectors: bool = True,
-            embedding_fn: Callable = None
+            embedding_fn: Callable = None,
+            cache_ttl: float | None = None,
+            use_begin_concurrent: bool = False
     ):
         """
         :param filename: path to database file
@@ -43,47 +271,198 @@ class SQRL:
         :param timeout: How many seconds the connection should wait before raising an OperationalError when a table is locked
         :param detect_types: control whether and how data types not natively supported by SQLite are looked up to be converted to Python types
         :param isolation_level: control legacy transaction handling behaviour
-        :param check_same_thread: flag for the db connection to check if running on the same thread (on by default)
-        :param cached_statements:he number of statements that sqlite3 should internally cache for this connection, to avoid parsing overhead. By default, 128 statements.
+        :param check_same_thread: flag for the db connection to check if running on the same thread (on by default),
+        on file databases every other thread gets its own connection regardless, in memory databases
+        can only be shared with it off, in which case access to the one connection is serialized by a lock
+        :param cached_statements: the number of statements that sqlite3 should internally cache for this connection, to avoid parsing overhead. By default, 512 statements.
+        statements built by sqrl keep the same text across calls, so repeated queries are prepared once per connection
         :param optimize: set journal mode to write ahead log and other optimizations (on by default)
         :param foreign_keys: enables foreign key flag (on by default)
         :param enable_vectors: flag for enabling vector capability
+        :param cache_ttl: (optional) seconds fetched select results are reused for identical
+        calls, cleared on any write through this instance (off by default)
+        :param use_begin_concurrent: open transaction() blocks with BEGIN CONCURRENT when the linked
+        sqlite is built from the begin-concurrent branch, otherwise BEGIN IMMEDIATE is used (off by default)
         """
         self.file: str = filename
-        self.con: sqlite.Connection = sqlite.connect(
-            filename,
+        self._connect_args: Dict[str, Any] = dict(
             timeout=timeout,
             detect_types=detect_types,
             isolation_level=isolation_level,
-            check_same_thread=check_same_thread,
             cached_statements=cached_statements,
         )
-        sqlite_version = self.fetch("select sqlite_version() LIMIT 1;")
-
-        print(f"sqlite_version={sqlite_version}")
-
-        # load sqlite-vec extension
-        if enable_vectors:
-            self.con.enable_load_extension(True)
-            sqlite_vec.load(self.con)
-            self.con.enable_load_extension(False)
-            vec_version = self.fetch("select vec_version() LIMIT 1;")
-            print(f"vec_version={vec_version}")
-        self._vectors_enabled = True
-        self.embed_function = embedding_fn
+        self._echo = echo
+        self._foreign_keys = foreign_keys
+        self._optimize = optimize
+        self._enable_vectors = enable_vectors
+        self._vec0_enabled = enable_vectors
+        self._hnsw_enabled = enable_vectors and vectorlite_py is not None
+        # vector table name -> (index kind, whether embeddings are int8 quantized)
+        self._vector_indexes: Dict[str, Tuple[str, bool]] = {}
+        # user defined functions, replayed on every connection opened later
+        self._functions: List[Tuple[str, int, Callable | None, bool]] = []
+        self.con: sqlite.Connection = sqlite.connect(
+            filename, check_same_thread=check_same_thread, **self._connect_args
+        )
+        # each thread works on its own connection, the creating thread on self.con
+        self._owner = _ConnectionState(self.con, shared=not check_same_thread)
+        self._local = threading.local()
+        self._local.state = self._owner
+        self._states: weakref.WeakSet[_ConnectionState] = weakref.WeakSet([self._owner])
+        # lazily built schema lookups, dropped whenever a statement may alter the schema
+        self.schema: Dict[str, frozenset[str]] | None = None
+        self._columns: Dict[str, List[str]] | None = None
+        self._table_name_set: frozenset[str] | None = None
+        # opt-in cache of select results keyed on (sql, params, one, return_as_dict)
+        self._cache_ttl: float | None = cache_ttl
+        self._query_cache: Dict[Tuple, Tuple[float, Any]] = {}
+        self._configure(self.con)
         if echo:
-            self.con.set_trace_callback(echo_callback)
-        if foreign_keys:
-            self.execute("pragma foreign_keys = on;")
+            # versions are only worth a round trip when asked to be verbose
+            print(f"sqlite_version={self.fetch('select sqlite_version();', one=True)}")
+            if enable_vectors:
+                print(f"vec_version={self.fetch('select vec_version();', one=True)}")
+        self._vectors_enabled = enable_vectors
+        self.embed_function = embedding_fn
+        # texts seen before, inserted or queried, skip the embedding model (least recently used first)
+        self._embed_cache: Dict[str | bytes, bytes] = {}
         if optimize and self.file != IN_MEMORY:
-            # enabled write ahead log journal mode if not already enabled
+            # the page size of a database is fixed once it has content (or is in WAL mode)
+            if self.fetch("pragma page_count;", one=True) == 0:
+                self.execute("pragma page_size = 4096;")
+            # enabled write ahead log journal mode if not already enabled,
+            # the mode persists in the file so only switch it once
             journal_mode = self.fetch("pragma journal_mode;", one=True)
             if journal_mode != 'wal':
-                self.executescript(
-                    "pragma journal_mode = WAL; pragma synchronous = normal; pragma journal_size_limit = 6144000;"
-                )
+                self.executescript("pragma journal_mode = WAL;")
+        self._begin = "BEGIN IMMEDIATE;"
+        if use_begin_concurrent and self._is_shareable():
+            # only sqlite builds from the begin-concurrent branch understand it
+            try:
+                self.con.execute("BEGIN CONCURRENT;")
+                self.con.rollback()
+                self._begin = "BEGIN CONCURRENT;"
+            except sqlite.OperationalError:
+                pass
+        if self._is_shareable():
+            # selects are served by a separate read-only connection, under WAL
+            # readers and the writer on the primary connection don't block each other
+            try:
+                ro = self._connect_reader(check_same_thread)
+            except sqlite.Error as e:
+                pass
+            else:
+                self._owner.reader = _ConnectionState(ro, shared=not check_same_thread)
+
+    def _is_shareable(self) -> bool:
+        """
+        whether more connections can be opened on the same database,
+        in memory databases only exist on the connection that created them
+        :return: boolean
+        """
+        return self.file not in (IN_MEMORY, "")
+
+    def _connect_reader(self, check_same_thread: bool = True) -> sqlite.Connection:
+        """
+        opens a configured read-only connection to the database file
+        :param check_same_thread: flag for the connection to check if running on the same thread
+        :return: sqlite connection
+        """
+        con = sqlite.connect(
+            f"{pathlib.Path(self.file).resolve().as_uri()}?mode=ro",
+            uri=True, check_same_thread=check_same_thread, **self._connect_args
+        )
+        self._configure(con)
+        return con
+
+    def _configure(self, con: sqlite.Connection) -> None:
+        """
+        applies the per connection setup (extensions, callbacks, functions, pragmas)
+        :param con: sqlite connection
+        :return: None
+        """
+        # load sqlite-vec extension
+        if self._enable_vectors:
+            try:
+                con.enable_load_extension(True)
+                sqlite_vec.load(con)
+            except (AttributeError, sqlite.OperationalError):
+                # python built without extension loading, vector tables use the flat index
+                self._vec0_enabled = self._hnsw_enabled = False
+            else:
+                if self._hnsw_enabled:
+                    try:
+                        con.load_extension(vectorlite_py.vectorlite_path())
+                    except sqlite.OperationalError:
+                        self._hnsw_enabled = False
+                con.enable_load_extension(False)
+            con.create_function("cos_dist", 2, utils.cosine_distance, deterministic=True)
+            con.create_function("cos_dist_i8", 2, utils.cosine_distance_int8, deterministic=True)
+        if self._echo:
+            con.set_trace_callback(echo_callback)
+        for name, narg, func, deterministic in self._functions:
+            con.create_function(name, narg, func, deterministic=deterministic)
+        if self._foreign_keys:
+            con.execute("pragma foreign_keys = on;")
+        if self._optimize and self.file != IN_MEMORY:
+            # per connection settings have to be applied on every open
+            # mmap turns page reads into memory loads, the negative cache size is in KiB
+            con.executescript(
+                "pragma synchronous = normal; pragma cache_size = -64000; pragma temp_store = MEMORY; "
+                "pragma mmap_size = 268435456; pragma wal_autocheckpoint = 1000; pragma journal_size_limit = 6144000;"
+            )
 
-        self.schema: Dict[str, List[str]] = {}
+    def _state(self) -> "_ConnectionState":
+        """
+        the connection state of the calling thread, threads other than the
+        creating one lazily open their own connection to the database
+        :return: connection state
+        """
+        state = getattr(self._local, "state", None)
+        if state is None:
+            if self._is_shareable():
+                con = sqlite.connect(self.file, check_same_thread=False, **self._connect_args)
+                self._configure(con)
+                state = _ConnectionState(con, shared=False)
+                self._states.add(state)
+            else:
+                # nothing else can see an in memory database, share the primary connection
+                state = self._owner
+            self._local.state = state
+        return state
+
+    def _conn(self) -> sqlite.Connection:
+        """
+        the connection of the calling thread
+        :return: sqlite connection
+        """
+        return self._state().con
+
+    def _read_cursor(self, sql: str) -> Tuple[sqlite.Cursor, Any]:
+        """
+        pick the cursor and lock a fetch should run on, plain selects go to the
+        read-only connection unless a transaction is open on the primary one
+        :param sql: sql statement to be executed
+        :return: tuple of cursor and its lock
+        """
+        state = self._state()
+        if state.reader is not None:
+            if not state.in_txn and _SELECT_RE.match(sql) and not _CONN_STATE_RE.search(sql):
+                return state.reader.cur_tuple, state.reader.lock
+            self._drop_reader(sql)
+        return state.cur_tuple, state.lock
+
+    def _drop_reader(self, statement: str) -> None:
+        """
+        stop using the read-only connection of the calling thread once a statement
+        creates objects only the primary connection can see (temporary or attached)
+        :param statement: sql statement about to be executed
+        :return: None
+        """
+        state = self._state()
+        if state.reader is not None and (_TEMP_RE.search(statement) or _ATTACH_RE.search(statement)):
+            state.reader.con.close()
+            state.reader = None
 
     def get_table_names(self) -> List[str]:
         """
@@ -95,32 +474,53 @@ class SQRL:
         )
         return tables
 
+    def _invalidate_schema(self, statement: str) -> None:
+        """
+        drop the cached schema lookups if a statement may change the schema
+        :param statement: sql statement about to be executed
+        :return: None
+        """
+        self._drop_reader(statement)
+        if _DDL_RE.search(statement):
+            self.schema = None
+            self._columns = None
+            self._table_name_set = None
+            self._vector_indexes.clear()
+
     def get_column_names(self, table_name: str) -> List[str]:
         """
         returns a list of all column names in a given table
         :param table_name: name of table in database
         :return: list of strings
         """
-        columns = self.fetch("PRAGMA table_info({});".format(table_name))
-        return [col[1] for col in columns]
+        if self._columns is not None and table_name in self._columns:
+            return list(self._columns[table_name])
+        # the table name is bound, so every table shares one cached statement
+        columns = self.fetch("SELECT name FROM pragma_table_info(?) ORDER BY cid;", table_name)
+        return columns if columns is not None else []
 
     def build_schema(self) -> None:
         """
         creates a quick lookup dictionary for
         the basic schema of the database
-        with table names and keys and a list of
+        with table names and keys and a set of
         column names as values
         :return: None
         """
-        self.schema.clear()
-
-        for table in self.get_table_names():
-            table_name = table
-            # get all of the current tables columns
-            self.schema[table_name] = self.get_column_names(table_name)
+        # every table's columns in one query rather than one per table
+        rows = self.fetch(
+            "SELECT m.name, p.name FROM sqlite_master m JOIN pragma_table_info(m.name) p "
+            "WHERE m.type='table' ORDER BY m.name, p.cid;"
+        ) or []
+        columns: Dict[str, List[str]] = {}
+        for table_name, column in rows:
+            columns.setdefault(table_name, []).append(column)
+        self._columns = columns
+        self.schema = {table_name: frozenset(cols) for table_name, cols in columns.items()}
+        self._table_name_set = frozenset(self.schema)
 
     def select(self, table_name: str,
-               columns: List[str] | None = None,
+               columns: List[str] | Tuple[str, ...] | None = None,
                distinct: bool = False,
                where: str | None = None,
                order_by: str | None = None,
@@ -131,6 +531,7 @@ class SQRL:
                offset: int = 0,
                fetch: None | int = None,
                return_as_dict: bool = False,
+               params: Tuple[Any, ...] = (),
                ) -> List[Dict[str, Any]] | Dict[str, Any] | List[Tuple[Any]] | List[sqlite.Row] | sqlite.Row | Tuple[
         Any]:
         """
@@ -151,25 +552,19 @@ class SQRL:
         :param fetch: number of items to fetch from return (default: None/all)
         :param row_factory: return a dict converitable rows or set to None to return tuples
         :param return_as_dict: returns already converted to dictionayr object
+        :param params: (optional) values bound to ? placeholders in the where and having clauses
         :return: list of items from select
         """
-        # format columns
-        if columns:
-            col_list = ",".join(columns)
-        else:
-            col_list = "*"
-
-        # build select statement
-        core = f"SELECT {'DISTINCT ' if distinct else ''}{col_list} FROM {table_name}"
-        where_chunk = '' if not where else f' WHERE {where}'
-        group_by_chunk = '' if not group_by else f' GROUP BY {group_by}'
-        having_chunk = '' if not having else f' HAVING {having}'
-        order_by_chunk = '' if not order_by else f" ORDER BY {order_by} {'ASC' if asc else 'DESC'}"
-        limit_offset_chunk = f" LIMIT {limit} OFFSET {offset};"
-
-        stmt = ''.join([core, where_chunk, group_by_chunk, having_chunk, order_by_chunk, limit_offset_chunk])
+        # build select statement, columns as a tuple so the composed sql can be cached
+        paged = limit >= 0 or offset != 0
+        stmt = _compose_select(
+            table_name, tuple(columns) if columns else None, distinct, where,
+            group_by, having, order_by, asc, paged
+        )
+        if paged:
+            params = (*params, limit, offset)
 
-        result = self.fetch(stmt, one=limit == 1, return_as_dict=return_as_dict)
+        result = self.fetch(stmt, *params, one=limit == 1, return_as_dict=return_as_dict)
         return result
 
     def insert(self,
@@ -185,14 +580,94 @@ class SQRL:
         :param returning: optional string input for a returning clause after insertion
         :return: boolean whether execution was successful
         """
-        columns, values = utils.process_dict(data)
-        core = "INSERT INTO" if not replace else "INSERT OR REPLACE INTO"
-        col_list = ','.join(columns)
-        val_list = ','.join(['?' for _ in values])
-        stmt = f"{core} {table_name} ({col_list}) VALUES ({val_list}){' RETURNING %s' % returning if returning else ''};"
+        # dicts keep insertion order, so keys and values line up
+        columns, values = (tuple(data.keys()), tuple(data.values())) if data else ((), ())
+        stmt = _compose_insert(table_name, columns, replace, returning)
         res = self.execute(stmt, *values, as_transaction=True, has_return=returning is not None)
         return res
 
+    def insert_many(self,
+                    table_name: str,
+                    rows: List[Dict[str, Any]],
+                    replace: bool = False) -> bool:
+        """
+        insert (or replace) many rows into a table within a single transaction
+        :param table_name: name of table in database
+        :param rows: list of dictionaries sharing the same column names
+        :param replace: flag of whether make it an OR REPLACE statement
+        :return: boolean whether execution was successful
+        """
+        if not rows:
+            return True
+        # keys are read once, each row only contributes its values
+        columns = utils.dict_keys_once(rows)
+        stmt = _compose_insert(table_name, columns, replace, None)
+        state = self._state()
+        try:
+            with self.transaction():
+                # values are produced as sqlite binds them, no list of parameters is built
+                state.cur_tuple.executemany(stmt, (utils.dict_values(row, columns) for row in rows))
+        except sqlite.Error as e:
+            if state.in_txn:
+                raise
+            print(e)
+            return False
+        return True
+
+    def compile_insert(self,
+                       table_name: str,
+                       columns: List[str] | Tuple[str, ...],
+                       replace: bool = False) -> Callable[[Tuple[Any, ...]], bool]:
+        """
+        specialize an insert for repeated use on one table,
+        the statement is built once and the returned function
+        only binds and executes it
+        :param table_name: name of table in database
+        :param columns: column names, in the order values will be given
+        :param replace: flag of whether make it an OR REPLACE statement
+        :return: function taking a tuple of values and returning whether execution was successful
+        """
+        return self._compile(_compose_insert(table_name, tuple(columns), replace, None))
+
+    def compile_update(self,
+                       table_name: str,
+                       columns: List[str] | Tuple[str, ...],
+                       where: str = "1 = 1") -> Callable[[Tuple[Any, ...]], bool]:
+        """
+        specialize an update for repeated use on one table
+        :param table_name: table name to update in
+        :param columns: column names to set, in the order values will be given
+        :param where: conditional clause for updating, may contain ? placeholders
+        :return: function taking a tuple of the new values followed by any where
+        parameters and returning whether execution was successful
+        """
+        return self._compile(_compose_update(table_name, tuple(columns), where, None))
+
+    def _compile(self, stmt: str) -> Callable[[Tuple[Any, ...]], bool]:
+        """
+        bind a fixed statement to the calling thread's pooled cursor
+        :param stmt: parameterized sql statement
+        :return: function executing the statement with the given values
+        """
+
+        def _do(values: Tuple[Any, ...]) -> bool:
+            self._query_cache.clear()
+            state = self._state()
+            with state.lock:
+                try:
+                    state.cur_tuple.execute(stmt, values)
+                    if not state.in_txn:
+                        state.con.commit()
+                    return True
+                except sqlite.Error as e:
+                    if state.in_txn:
+                        raise
+                    print(e)
+                    state.con.rollback()
+                    return False
+
+        return _do
+
     def update(self,
                table_name: str,
                data: Dict[str, Any],
@@ -206,10 +681,8 @@ class SQRL:
         :param returning: optional string input for a returning clause after update
         :return: boolean whether execution was successful
         """
-        columns, values = utils.process_dict(data)
-
-        params = ', '.join([f"{c} = ?" for c in columns])
-        stmt = f"UPDATE {table_name} SET {params} WHERE {where}{' RETURNING %s' % returning if returning else ''};"
+        columns, values = (tuple(data.keys()), tuple(data.values())) if data else ((), ())
+        stmt = _compose_update(table_name, columns, where, returning)
 
         res = self.execute(stmt, *values, as_transaction=True, has_return=returning is not None)
         return res
@@ -227,8 +700,7 @@ class SQRL:
         :param vacuum: flag to specify whether to vacuum db after this delete operation
         :return: boolean of whether execution was successful
         """
-
-        stmt = f"DELETE FROM {table_name} WHERE {where}{' RETURNING %s' % returning if returning else ''};"
+        stmt = _compose_delete(table_name, where, returning)
 
         success = self.execute(stmt, as_transaction=True, has_return=returning is not None)
         if vacuum and success:
@@ -241,7 +713,12 @@ class SQRL:
         :param name: name of table
         :return: True if exists else False
         """
-        return name in self.get_table_names()
+        if self._table_name_set is None:
+            # a single probe is cheaper than listing every table for one answer
+            return self.fetch(
+                "SELECT 1 FROM sqlite_master WHERE type='table' AND name = ? LIMIT 1;", name, one=True
+            ) is not None
+        return name in self._table_name_set
 
     def column_exists_in_table(self, table_name: str, column: str) -> bool:
         """
@@ -250,12 +727,12 @@ class SQRL:
         :param column: column name
         :return: True if column is in table else False
         """
-        if len(self.schema) == 0:
-            self.build_schema()
-        table_cols = self.schema.get(table_name, None)
-        if table_cols is None:
-            return False
-        column_found: bool = column in self.schema[table_name]
+        if self.schema is None:
+            # probe the one table instead of building the whole schema
+            return self.fetch(
+                "SELECT 1 FROM pragma_table_info(?) WHERE name = ? LIMIT 1;", table_name, column, one=True
+            ) is not None
+        column_found: bool = column in self.schema.get(table_name, ())
         return column_found
 
     def fetch_first_value(self, __sql: str, *__params) -> Any:
@@ -267,7 +744,8 @@ class SQRL:
         :return: value of first column of rows
         """
         out = self.fetch(__sql, *__params, one=True)
-        return out if not out else out[0]
+        # single column rows are already unwrapped by fetch
+        return out[0] if isinstance(out, tuple) else out
 
     def aggregate(self, table_name: str, column: str, agg: str) -> Any:
         """
@@ -278,7 +756,7 @@ class SQRL:
         :param agg: aggregate function (i.e. SUM, AVG)
         :return: result of aggregate
         """
-        stmt = f"SELECT {agg}({column}) FROM {table_name};"
+        stmt = _compose_aggregate(table_name, column, agg)
         a = self.fetch(stmt, one=True)
         return a
 
@@ -351,25 +829,57 @@ class SQRL:
         return dict convertible Row objects
         :return: result of fetch
         """
+        key = None
+        if self._cache_ttl is not None:
+            if _SELECT_RE.match(sql):
+                key = (sql, params, one, return_as_dict)
+                try:
+                    hit = self._query_cache.get(key)
+                except TypeError:  # unhashable parameter values
+                    key = hit = None
+                if hit is not None and time.monotonic() - hit[0] < self._cache_ttl:
+                    return _copy_result(hit[1])
+            else:
+                # anything but a select may write (e.g. RETURNING)
+                self._query_cache.clear()
+        result = self._fetch(sql, params, one, return_as_dict)
+        if key is not None and result is not None:
+            if len(self._query_cache) >= _QUERY_CACHE_SIZE:
+                self._query_cache.clear()
+            self._query_cache[key] = (time.monotonic(), result)
+            return _copy_result(result)
+        return result
+
+    def _fetch(self, sql: str, params: Tuple[Any, ...], one: bool, return_as_dict: bool) -> Any:
+        """
+        runs a fetch statement against the database, see fetch
+        :return: result of fetch
+        """
         try:
             params = list(params)
-            one = one or re.match(r"^.+ LIMIT 1(?=(\s|;)).*", sql, flags=re.IGNORECASE)
-            self.con.row_factory = sqlite.Row if return_as_dict else None
-            # select rows from database
-            rows = [
-                dict(row) if return_as_dict else row for row in self.con.execute(sql, params)
-            ]
+            one = one or _LIMIT1_RE.search(sql) is not None
+            cur, lock = self._read_cursor(sql)
+            # select rows from database as plain tuples in one batch
+            with lock:
+                rows = cur.execute(sql, params).fetchall()
+                keys = [d[0] for d in cur.description] if return_as_dict and rows else None
 
             if len(rows) == 0:
                 return None if one else []
 
+            if return_as_dict:
+                # column names are looked up once, not per row
+                if one:
+                    return dict(zip(keys, rows[0]))
+                return [dict(zip(keys, row)) for row in rows]
+
             if one:
                 row = rows[0]
-                if len(row) == 1 and not return_as_dict:
+                if len(row) == 1:
                     return row[0]
                 return row
             else:
-                if len(rows[0]) == 1 and not return_as_dict:
+                if len(rows[0]) == 1:
                     return [row[0] for row in rows]
                 return rows
 
@@ -385,54 +895,98 @@ class SQRL:
         execute an sql statement
         :param statement: sql statement
         :param params: (optional) parameter values
-        :param as_transaction: flag of whether to run
-        the execution as a transaction
+        :param as_transaction: kept for compatibility, a single statement
+        is already atomic, use transaction() to group several statements
         :param has_return: flag of whether statement returns data
         (e.g. UPDATE BOOKS SET isbn = '1234' WHERE id = 1 RETURNING *;
         :return: boolean whether execution was successful
         """
-        cur = self.con.cursor()
-        try:
-            if as_transaction:
-                cur.execute("BEGIN TRANSACTION;")
-            cur.execute(statement, list(params))
-            out = cur.fetchall() if has_return else True
-            self.con.commit()
-            return out
-        except sqlite.Error as e:
-            print(e)
-            self.con.rollback()
-            return False
+        self._invalidate_schema(statement)
+        self._query_cache.clear()
+        state = self._state()
+        with state.lock:
+            cur = state.cur_tuple
+            try:
+                cur.execute(statement, list(params))
+                out = cur.fetchall() if has_return else True
+                if not state.in_txn:
+                    state.con.commit()
+                return out
+            except sqlite.Error as e:
+                if state.in_txn:
+                    # let transaction() roll back the whole block
+                    raise
+                print(e)
+                state.con.rollback()
+                return False
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """
+        context manager grouping several statements into one transaction,
+        committed once when the block exits and rolled back if it raises.
+        inside the block failing statements raise instead of returning False
+        e.g. with db.transaction(): for row in rows: db.insert("t", row)
+        :return: the SQRL instance
+        """
+        state = self._state()
+        with state.lock:
+            if state.in_txn:
+                # nested blocks join the outer transaction
+                yield self
+                return
+            state.cur_tuple.execute(self._begin)
+            state.in_txn = True
+            try:
+                yield self
+            except BaseException:
+                state.con.rollback()
+                raise
+            else:
+                state.con.commit()
+            finally:
+                state.in_txn = False
+                self._query_cache.clear()
 
     def executescript(self, __sql: str) -> bool:
         """
-        executes an sql script
+        executes an sql script, inside transaction() its statements join the open
+        transaction (sqlite's own executescript would commit it first) and failures raise
         :param __sql: sql script
         :return: boolean whether the execution was successful
         """
-        cur = self.con.cursor()
-        try:
-            cur.executescript(__sql)
-            self.con.commit()
-        except sqlite.Error as e:
-            self.con.rollback()
-            return False
+        self._invalidate_schema(__sql)
+        self._query_cache.clear()
+        state = self._state()
+        with state.lock:
+            if state.in_txn:
+                for statement in _split_script(__sql):
+                    state.cur_tuple.execute(statement)
+                return True
+            try:
+                state.con.executescript(__sql)
+                state.con.commit()
+            except sqlite.Error as e:
+                state.con.rollback()
+                return False
         return True
 
     def executemany(self, __sql: str, __seq_of_params) -> bool:
         """
         executes an sql statement many times on
-        a sequence of parameter values
+        a sequence of parameter values within a single transaction
         :param __sql: sql statement
         :param __seq_of_params: sequence of data
         :return: boolean whether execution was successful
         """
-        cur = self.con.cursor()
+        state = self._state()
         try:
-            cur.executemany(__sql, __seq_of_params)
-            self.con.commit()
+            # without an explicit transaction autocommit would commit every row
+            with self.transaction():
+                state.cur_tuple.executemany(__sql, __seq_of_params)
         except sqlite.Error as e:
-            self.con.rollback()
+            if state.in_txn:
+                raise
             return False
         return True
 
@@ -460,25 +1014,45 @@ class SQRL:
         if not out_file:
             out_file = "%s.sql" % self.__get_database_name()
         if schema_only:
-            # fetch table defintions
-            defs = self.fetch(
-                "SELECT sql || ';' FROM sqlite_master WHERE type='table' AND sql NOT NULL;"
-            )
-            lines = '\n'.join(defs)
-        else:
-            lines = '\n'.join(self.con.iterdump())
+            # stream table defintions straight from the cursor
+            sql = "SELECT sql || ';' FROM sqlite_master WHERE type='table' AND sql NOT NULL;"
+            cur, lock = self._read_cursor(sql)
+            with lock, open(out_file, 'w', encoding="utf-8", newline='\n') as dst:
+                dst.writelines(row[0] + '\n' for row in cur.execute(sql))
+            return
 
-        with open(out_file, 'w', encoding="utf-16") as dst:
-            dst.writelines(lines)
+        # iterdump yields one statement at a time, never join the whole dump in memory
+        with open(out_file, 'w', encoding="utf-8", newline='\n') as dst:
+            dst.writelines(line + '\n' for line in self._conn().iterdump())
 
     def export_to_csv(self, delimeter: str = ',') -> None:
         """
         exports every table in the database
-        to seperate csvs
+        to seperate csvs, file databases export
+        their tables in parallel
+        :return: None
+        """
+        tables = self.get_table_names()
+        if not self._is_shareable() or len(tables) < 2:
+            for table in tables:
+                self.export_table_to_csv(table_name=table, delimeter=delimeter)
+            return
+        # every worker reads through its own read-only connection, under WAL readers don't block each other
+        with concurrent.futures.ThreadPoolExecutor(max_workers=min(8, len(tables))) as ex:
+            list(ex.map(lambda table: self._export_one(table, delimeter), tables))
+
+    def _export_one(self, table_name: str, delimeter: str) -> None:
+        """
+        exports a table to csv over a private read-only connection
+        :param table_name: name of table
+        :param delimeter: csv file delimeter character
         :return: None
         """
-        for table in self.get_table_names():
-            self.export_table_to_csv(table_name=table, delimeter=delimeter)
+        con = self._connect_reader()
+        try:
+            self._write_csv(con.cursor(), table_name, delimeter)
+        finally:
+            con.close()
 
     def to_json(self, table_name: str, filename: str | None = None) -> bool:
         """
@@ -489,12 +1063,20 @@ class SQRL:
         """
         if not filename:
             filename = './{}.json'.format(table_name)
-        result = self.select(table_name, return_as_dict=True)
-        if result is None:
-            return False
+        sql = f"SELECT * FROM {table_name};"
+        cur, lock = self._read_cursor(sql)
         try:
-            with open(filename, 'w') as file:
-                json.dump(result, file)
+            with lock:
+                cur.execute(sql)
+                keys = [d[0] for d in cur.description]
+                # rows are encoded one at a time, neither the rows nor the document are held in memory
+                with open(filename, 'w') as file:
+                    file.write('[')
+                    for i, row in enumerate(cur):
+                        if i:
+                            file.write(', ')
+                        file.write(json.dumps(dict(zip(keys, row))))
+                    file.write(']')
         except Exception as e:
             return False
         return True
@@ -508,16 +1090,30 @@ class SQRL:
         """
         if not self.table_exists(table_name):
             return
+        state = self._state()
+        with state.lock:
+            self._write_csv(state.cur_tuple, table_name, delimeter)
+
+    def _write_csv(self, cur: sqlite.Cursor, table_name: str, delimeter: str) -> None:
+        """
+        streams a table from a tuple cursor into its csv file
+        :param cur: cursor returning tuples
+        :param table_name: name of table
+        :param delimeter: csv file delimeter character
+        :return: None
+        """
         outfile = f"./{self.__get_database_name()}-{table_name}.csv"
-        rows = [row for row in self.select(table_name, return_as_dict=True)]
-        if not len(rows):
+        # stream tuples straight from the cursor into the writer
+        cur.execute(f"SELECT * FROM {table_name};")
+        first = cur.fetchone()
+        if first is None:
             return
-        headers = list(rows[0].keys())  # extract column header line
-        csv_rows = [list(row.values()) for row in rows]
+        headers = [d[0] for d in cur.description]  # extract column header line
         with open(outfile, 'w', newline='', encoding='UTF-8') as csv_file:
             writer = _csv.writer(csv_file, delimiter=delimeter)
             writer.writerow(headers)
-            writer.writerows(csv_rows)
+            writer.writerow(first)
+            writer.writerows(cur)
 
     def register_adapter(self, type: object, adapter: Callable):
         """
@@ -549,9 +1145,13 @@ class SQRL:
         :param deterministic:
         :return: None
         """
-        self.con.create_function(
-            name, narg, func, deterministic=deterministic
-        )
+        self._functions.append((name, narg, func, deterministic))
+        for state in list(self._states):
+            for con in (state.con, state.reader.con if state.reader else None):
+                if con is not None:
+                    con.create_function(
+                        name, narg, func, deterministic=deterministic
+                    )
 
     def backup(self, filename: str, pages: int = -1, quiet: bool = True):
         """
@@ -562,7 +1162,7 @@ class SQRL:
         :return: None
         """
         with sqlite.connect(filename) as dst:
-            self.con.backup(
+            self._conn().backup(
                 dst,
                 pages=pages,
                 progress=None if quiet else progress_callback
@@ -574,29 +1174,47 @@ class SQRL:
         :param dataframe: a pandas dataframe
         :param table_name: name of the table to be created
         :param strict: flag for whether to create and fill table only if all rows are
-        successfully inserted, defaults to False
+        successfully inserted, otherwise rows that fail are skipped, defaults to False
         :return: boolean of creation and population success
         """
-        # create table
+        # create table, column types come from the dtypes rather than converting rows
         columns = dataframe.columns.to_list()
-        tmp = dataframe.dropna().to_dict(orient='records')
         col_defs = []
-        for k, v in tmp[0].items():
-            c = f"{k} {utils.detect_type_json(v)}"
-            col_defs.append(c)
+        for k, dtype in dataframe.dtypes.items():
+            if dtype.kind in "iub":
+                col_type = utils.INTEGER
+            elif dtype.kind == "f":
+                col_type = utils.REAL
+            else:
+                # positional, so duplicate index labels still give a single value
+                values = dataframe[k].dropna()
+                col_type = utils.detect_type_json(values.iat[0]) if len(values) else utils.TEXT
+            col_defs.append(f"{k} {col_type}")
         table_stmt = f"CREATE TABLE {table_name} ({', '.join(col_defs)});"
         if not self.execute(table_stmt):
             return False
-        # populate table
-        rows = dataframe.to_dict(orient='records')
-        insert_stmt = f"INSERT INTO {table_name} ({','.join(columns)}) VALUES ({','.join('?' * len(columns))});"
-
-        for row in rows:
-            if not self.insert(table_name=table_name, data=row) and strict:
-                # clean up
-                self.execute(f"DELETE FROM {table_name};")
+        # populate table with one executemany over plain tuples in a single transaction
+        insert_stmt = _compose_insert(table_name, tuple(columns), False, None)
+        kinds = {dtype.kind for dtype in dataframe.dtypes}
+        if len(set(dataframe.dtypes)) == 1 and kinds <= set("iufb"):
+            # a single numeric dtype converts to python rows in one go
+            rows = dataframe.to_numpy().tolist()
+        else:
+            rows = dataframe.itertuples(index=False, name=None)
+        state = self._state()
+        try:
+            with self.transaction():
+                state.cur_tuple.executemany(insert_stmt, rows)
+        except sqlite.Error as e:
+            if state.in_txn:
+                raise
+            if strict:
+                # the batch was rolled back, clean up the table
                 self.execute(f"DROP TABLE {table_name};")
                 return False
+            # keep every row that can be inserted
+            for row in dataframe.itertuples(index=False, name=None):
+                self.execute(insert_stmt, *row)
 
         return True
 
@@ -611,20 +1229,46 @@ class SQRL:
         if name is None:
             name = utils.extract_filename(filename).lower()
         name = utils.safe_name(name)
-        headers, rows = utils.read_csv(filename)
+        # rows are read and inserted a chunk at a time, the file is never held in memory whole,
+        # parsed by pyarrow when installed, otherwise (or if it can't read the file) by the csv module
+        chunks = None
+        if _pacsv is not None:
+            try:
+                chunks = _iter_csv_arrow(filename)
+            except (_pa.ArrowInvalid, UnicodeDecodeError):
+                pass
+        if chunks is None:
+            # blank lines are skipped, as pyarrow does
+            chunks = ((h, [row for row in rows if row]) for h, rows in utils.iter_csv(filename))
+        headers, rows = next(chunks, ([], []))
         if len(rows) == 0:
             return False
+        headers = [h.replace(' ', '_') for h in headers]
+        # each column is typed from all of its values in the first chunk, not just the first row,
+        # short rows are left to fail the insert below
         columns = []
-        for i, v in enumerate(rows[0]):
-            col = "{} {}".format(headers[i].replace(' ', '_'), utils.detect_type_csv(v))
+        for i, header in enumerate(headers):
+            values = (row[i] if i < len(row) else None for row in rows)
+            col = "{} {}".format(header, utils.infer_column_type(values))
             columns.append(col)
         create_stmt = f"CREATE TABLE {name} ({','.join(columns)});"
         if not self.execute(create_stmt):
             return False
 
         insert_stmt = f"INSERT INTO {name} ({','.join(headers)}) VALUES ({','.join('?' * len(columns))});"
-
-        return self.executemany(insert_stmt, rows)
+        state = self._state()
+        try:
+            with self.transaction():
+                state.cur_tuple.executemany(insert_stmt, rows)
+                for _, rows in chunks:
+                    state.cur_tuple.executemany(insert_stmt, rows)
+        except _CSV_ERRORS as e:
+            if state.in_txn:
+                # let transaction() roll back the whole block
+                raise
+            print(e)
+            return False
+        return True
 
     def create_table_from_json(self, filename: str, name: str | None = None) -> bool:
         """
@@ -657,47 +1301,236 @@ class SQRL:
             if not self.execute(statement):  # error in creation or table name exists
                 return False
 
-            success = True
-            for x in data:
-                success = success and self.insert(name, x)
-            return success
+            insert_stmt = _compose_insert(name, tuple(keys), False, None)
+            return self.executemany(insert_stmt, [[obj.get(k) for k in keys] for obj in data])
 
-    def add_embedding(self, table_name: str, text: str) -> bool:
+    def _serialized_embedding(self, text: str, key: str | bytes | None = None) -> bytes:
+        """
+        embeds a text and serializes the vector, served from the
+        embedding cache when the text was seen before
+        :param text: text for the embedding
+        :param key: (optional) cache key of the text if already computed
+        :return: raw bytes of the embedding
+        """
+        if key is None:
+            key = _embed_key(text)
+        embedding = self._embed_cache.pop(key, None)
+        if embedding is None:
+            embedding = utils.serialize(self.embed_function(text))
+        self._cache_embedding(key, embedding)
+        return embedding
+
+    def _cache_embedding(self, key: str | bytes, embedding: bytes) -> None:
+        """
+        stores a serialized embedding as the most recently used, dropping the least recently used one when full
+        :param key: cache key of the text, see _embed_key
+        :param embedding: raw bytes of the embedding
+        :return: None
+        """
+        self._embed_cache.pop(key, None)
+        if len(self._embed_cache) >= _EMBED_CACHE_SIZE:
+            del self._embed_cache[next(iter(self._embed_cache))]
+        self._embed_cache[key] = embedding
+
+    def add_embedding(self, table_name: str, text: str, embedding=None) -> bool:
         """
         insert a text into an existing vector table
         :param table_name: name of vector table
         :param text: text for the embedding
+        :param embedding: (optional) precomputed vector for the text, skips calling the embedding function
+        :return: boolean success
+        """
+
+        if not self._vectors_enabled:
+            raise RuntimeError("vectors not enabled.")
+
+        embedding = self._serialized_embedding(text) if embedding is None else utils.serialize(embedding)
+
+        return self._insert_embeddings(table_name, [(text, embedding)])
+
+    def add_embeddings(self, table_name: str, texts: List[str]) -> bool:
+        """
+        insert many texts into an existing vector table in a single transaction.
+        an embedding function flagged with `__batched__ = True` is called once with
+        the whole list and should return one vector per text, otherwise it is called per text
+        :param table_name: name of vector table
+        :param texts: texts for the embeddings
         :return: boolean success
         """
 
         if not self._vectors_enabled:
             raise RuntimeError("vectors not enabled.")
 
-        embedding = utils.serialize(self.embed_function(text))
+        texts = list(texts)
+        if getattr(self.embed_function, "__batched__", False):
+            # only texts missing from the cache are embedded, in one call
+            keys = [_embed_key(text) for text in texts]
+            missing = {}
+            for text, key in zip(texts, keys):
+                if key not in self._embed_cache:
+                    missing.setdefault(key, text)
+            if missing:
+                for key, vector in zip(missing, self.embed_function(list(missing.values()))):
+                    self._cache_embedding(key, utils.serialize(vector))
+            rows = [(text, self._serialized_embedding(text, key)) for text, key in zip(texts, keys)]
+        else:
+            rows = [(text, self._serialized_embedding(text)) for text in texts]
+        return self._insert_embeddings(table_name, rows)
 
-        return self.execute(f"INSERT INTO {table_name}(content, embedding) VALUES (?, ?);", text, embedding)
+    def _insert_embeddings(self, table_name: str, rows: List[Tuple[str, bytes]]) -> bool:
+        """
+        inserts texts and their serialized embeddings in a single transaction,
+        in the form the vector table stores them
+        :param table_name: name of vector table
+        :param rows: (text, serialized embedding) pairs
+        :return: boolean success
+        """
+        index, int8 = self._vector_index(table_name)
+        if int8:
+            rows = [(text, utils.quantize_int8(embedding)) for text, embedding in rows]
+        if index == "hnsw":
+            return self._insert_hnsw(table_name, rows)
+        if int8 and index == "vec0":
+            # vec0 takes int8 vectors tagged with vec_int8
+            stmt = f"INSERT INTO {table_name}(content, embedding) VALUES (?, vec_int8(?));"
+        else:
+            stmt = _compose_insert(table_name, ("content", "embedding"), False, None)
+        return self.executemany(stmt, rows)
 
-    def create_embedding_db(self, table_name: str, dim: int) -> bool:
+    def _insert_hnsw(self, table_name: str, rows: List[Tuple[str, bytes]]) -> bool:
+        """
+        inserts texts into the content table of an hnsw index and
+        their embeddings into the index under the same rowid
+        :param table_name: name of vector table
+        :param rows: (text, serialized embedding) pairs
+        :return: boolean success
+        """
+        state = self._hnsw_state()
+        with state.lock:
+            own_txn = not state.in_txn
+            cur = state.cur_tuple
+            try:
+                if own_txn:
+                    cur.execute(self._begin)
+                for text, embedding in rows:
+                    cur.execute(f"INSERT INTO {table_name}_content(content) VALUES (?);", (text,))
+                    cur.execute(f"INSERT INTO {table_name}(rowid, embedding) VALUES (?, ?);",
+                                (cur.lastrowid, embedding))
+                if own_txn:
+                    state.con.commit()
+            except sqlite.Error as e:
+                if not own_txn:
+                    # let transaction() roll back the whole block
+                    raise
+                state.con.rollback()
+                print(e)
+                return False
+        self._query_cache.clear()
+        return True
+
+    def _hnsw_state(self) -> "_ConnectionState":
+        """
+        the connection state hnsw indexes are read and written through. vectorlite keeps
+        the index in the memory of the connection that loaded it, so other threads go
+        through the primary connection, which requires check_same_thread=False
+        :return: connection state of the primary connection
+        """
+        state = self._state()
+        if state is self._owner:
+            return state
+        if not self._owner.shared:
+            raise RuntimeError("hnsw indexes can only be used from other threads with check_same_thread=False.")
+        if state.in_txn:
+            raise RuntimeError("hnsw indexes can't be written inside a transaction opened on another thread.")
+        return self._owner
+
+    def _vector_index(self, table_name: str) -> Tuple[str, bool]:
+        """
+        the kind of index behind a vector table, read from its definition
+        :param table_name: name of vector table
+        :return: "hnsw" for vectorlite tables, "vec0" for sqlite-vec tables, otherwise "flat",
+        and whether the embeddings are int8 quantized
+        """
+        index = self._vector_indexes.get(table_name)
+        if index is None:
+            sql = self.fetch("SELECT sql FROM sqlite_master WHERE name = ?;", table_name, one=True) or ""
+            module = _USING_RE.search(sql)
+            module = module.group(1).lower() if module else None
+            kind = "hnsw" if module == "vectorlite" else "vec0" if module == "vec0" else "flat"
+            index = self._vector_indexes[table_name] = (kind, _INT8_RE.search(sql) is not None)
+        return index
+
+    def create_embedding_db(self,
+                            table_name: str,
+                            dim: int,
+                            index: str = "vec0",
+                            m: int = 16,
+                            ef_construction: int = 64,
+                            max_elements: int = 100000,
+                            quantization: str = "f32"
+                            ) -> bool:
         """
         create a new virtual table for working with vectors
-        leveraging sqlite-vec
+        leveraging sqlite-vec, or an hnsw index leveraging vectorlite.
+        the hnsw index is held in memory by the primary connection, every thread's reads
+        and writes go through it, for file databases it is saved next to the database file on close.
+        falls back to sqlite-vec when vectorlite is not installed, and to a plain
+        table searched by cosine distance (cos_dist) when sqlite-vec can't be loaded
         :param table_name: name of vector table to create
         :param dim: size of float arrays for vectors to be inserted
+        :param index: "vec0" for exact linear search, "hnsw" for approximate graph search,
+        "flat" for exact cosine distance search in a plain table
+        :param m: (hnsw) max number of graph neighbours per vector
+        :param ef_construction: (hnsw) candidate list size while building the graph
+        :param max_elements: (hnsw) capacity of the index
+        :param quantization: "f32" to store embeddings as is, "int8" (vec0 and flat only) to store them
+        scalar quantized in a quarter of the space, int8 tables are ranked by cosine distance
         :return: success boolean
         """
         if not self._vectors_enabled:
             raise RuntimeError("vectors not enabled.")
+        if index not in ("vec0", "hnsw", "flat"):
+            raise ValueError(f"unknown vector index '{index}', expected 'vec0', 'hnsw' or 'flat'.")
+        if quantization not in ("f32", "int8"):
+            raise ValueError(f"unknown quantization '{quantization}', expected 'f32' or 'int8'.")
+        if quantization == "int8" and index == "hnsw":
+            raise ValueError("int8 quantization is not supported by hnsw indexes.")
+        if index == "hnsw" and self._hnsw_enabled:
+            if self._state() is not self._owner:
+                raise RuntimeError("hnsw indexes can only be created from the thread that opened the database.")
+            index_file = ""
+            if self.file != IN_MEMORY:
+                path = _op.join(_op.dirname(_op.abspath(self.file)), f"{self.__get_database_name()}_{table_name}.hnsw")
+                index_file = ", '" + path.replace("'", "''") + "'"
+            try:
+                with self.transaction():
+                    self.execute(f"CREATE TABLE {table_name}_content (id INTEGER PRIMARY KEY, content TEXT NOT NULL UNIQUE);")
+                    self.execute(
+                        f"CREATE VIRTUAL TABLE {table_name} USING vectorlite("
+                        f"embedding float32[{dim}], "
+                        f"hnsw(max_elements={max_elements}, ef_construction={ef_construction}, M={m}){index_file});"
+                    )
+            except sqlite.Error as e:
+                print(e)
+                return False
+            return True
+        int8 = quantization == "int8"
+        if index == "flat" or not self._vec0_enabled:
+            return self.execute(
+                f"CREATE TABLE {table_name} (id INTEGER PRIMARY KEY, content TEXT NOT NULL UNIQUE, "
+                f"embedding {'INT8' if int8 else 'BLOB'} NOT NULL);"
+            )
         return self.execute(
             f"""
                    CREATE VIRTUAL TABLE {table_name} USING vec0(
                        id INTEGER PRIMARY KEY,
                        content TEXT NOT NULL UNQIUE,
-                       embedding FLOAT[{dim}]
+                       {f'embedding INT8[{dim}] distance_metric=cosine' if int8 else f'embedding FLOAT[{dim}]'}
                    );
                    """
         )
 
-    def k_nearest_embeddings(self, table_name: str, query: str, k: int) -> List[
+    def k_nearest_embeddings(self, table_name: str, query: str, k: int, ef_search: int = None) -> List[
         Tuple[int, str, float]]:
         """
         returns the k nearest embeddings and their respective text content to
@@ -705,14 +1538,54 @@ class SQRL:
         :param table_name: name of vector table
         :param query: a string of query to converted to vector embedding
         :param k: number of results to return
-        :return: list of tuple (id, text content, distance)
+        :param ef_search: (hnsw) candidate list size while searching, higher is more accurate but slower
+        :return: list of tuple (id, text content, distance), the distance is cosine for flat and int8 tables,
+        squared euclidean for hnsw tables and euclidean otherwise
         """
         if not self._vectors_enabled:
             raise RuntimeError("vectors not enabled.")
 
-        embedding = utils.serialize(
-            self.embed_function(query)
-        )
+        embedding = self._serialized_embedding(query)
+        index, int8 = self._vector_index(table_name)
+        if int8:
+            embedding = utils.quantize_int8(embedding)
+
+        if index == "flat":
+            return self.fetch(
+                f"""
+                SELECT
+                id,
+                content,
+                {'cos_dist_i8' if int8 else 'cos_dist'}(embedding, ?) AS distance
+                FROM {table_name}
+                ORDER BY distance
+                LIMIT ?
+                """,
+                embedding, k
+            )
+
+        if index == "hnsw":
+            params = (embedding, k) if ef_search is None else (embedding, k, ef_search)
+            knn = "knn_param(?, ?)" if ef_search is None else "knn_param(?, ?, ?)"
+            state = self._hnsw_state()
+            try:
+                # the index lives on the primary connection, never the read-only one
+                with state.lock:
+                    return state.cur_tuple.execute(
+                        f"""
+                        SELECT
+                        c.id,
+                        c.content,
+                        v.distance
+                        FROM (SELECT rowid, distance FROM {table_name} WHERE knn_search(embedding, {knn})) v
+                        JOIN {table_name}_content c ON c.id = v.rowid
+                        ORDER BY v.distance
+                        """,
+                        params
+                    ).fetchall()
+            except sqlite.Error as e:
+                print(e)
+                return None
 
         return self.fetch(
             f"""
@@ -722,11 +1595,24 @@ class SQRL:
             distance
             FROM {table_name}
             WHERE 
-            embedding MATCH ? AND k = ?
+            embedding MATCH {'vec_int8(?)' if int8 else '?'} AND k = ?
             ORDER BY distance
             """,
             embedding, k
         )
 
+    def __enter__(self) -> "SQRL":
+        return self
+
     def __exit__(self, exc_type, exc_val, exc_tb):
-        self.con.close()
+        self.close()
+
+    def close(self) -> None:
+        """
+        closes every connection opened by this instance
+        :return: None
+        """
+        for state in list(self._states):
+            if state.reader is not None:
+                state.reader.con.close()
+            state.con.close()
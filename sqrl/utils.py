@@ -2,21 +2,97 @@
 Oliver 2024
 """
 import os.path
-import re
-from typing import List, Dict, Any, Tuple
+from typing import List, Dict, Any, Tuple, Iterator
 import csv
+import functools
+import io
+import itertools
+import math
 import struct
+import sys
+
+try:
+    import numpy as _np
+except ImportError:  # optional, serialize falls back to struct packing
+    _np = None
 
 
 def serialize(vector: List[float]) -> bytes:
     """
-    serializes a list of floats into bytes format
-    :param vector: list of floats
+    serializes a list of floats into bytes format,
+    with numpy installed this is a single float32 copy
+    :param vector: list of floats or numpy array
     :return: raw bytes of vector
     """
+    if _np is not None:
+        return _np.ascontiguousarray(vector, dtype=_np.float32).tobytes()
     return struct.pack("%sf" % len(vector), *vector)
 
 
+def cosine_distance(a: bytes, b: bytes) -> float | None:
+    """
+    cosine distance between two serialized float32 vectors,
+    registered on vector enabled connections as the sql function cos_dist
+    :param a: raw bytes of vector
+    :param b: raw bytes of vector
+    :return: 1 - cosine similarity
+    """
+    if a is None or b is None:
+        return None
+    if _np is not None:
+        x = _np.frombuffer(a, dtype=_np.float32)
+        y = _np.frombuffer(b, dtype=_np.float32)
+        norm = float(_np.linalg.norm(x) * _np.linalg.norm(y))
+        return 1.0 - float(x @ y) / norm if norm else 1.0
+    x = struct.unpack("%sf" % (len(a) // 4), a)
+    y = struct.unpack("%sf" % (len(b) // 4), b)
+    norm = math.sqrt(sum(v * v for v in x) * sum(v * v for v in y))
+    return 1.0 - sum(p * q for p, q in zip(x, y)) / norm if norm else 1.0
+
+
+def quantize_int8(vector) -> bytes:
+    """
+    scalar quantizes a vector to int8, scaled so its largest component maps to 127.
+    the scale is not kept, cosine distance doesn't depend on it
+    :param vector: list of floats, numpy array or raw float32 bytes (see serialize)
+    :return: raw bytes of the int8 vector
+    """
+    if _np is not None:
+        if isinstance(vector, (bytes, bytearray, memoryview)):
+            v = _np.frombuffer(vector, dtype=_np.float32)
+        else:
+            v = _np.asarray(vector, dtype=_np.float32)
+        peak = float(_np.abs(v).max()) if v.size else 0.0
+        return (v * (127.0 / peak if peak else 1.0)).round().astype(_np.int8).tobytes()
+    if isinstance(vector, (bytes, bytearray, memoryview)):
+        vector = struct.unpack("%sf" % (len(vector) // 4), vector)
+    peak = max((abs(v) for v in vector), default=0.0)
+    scale = 127.0 / peak if peak else 1.0
+    return struct.pack("%sb" % len(vector), *(round(v * scale) for v in vector))
+
+
+def cosine_distance_int8(a: bytes, b: bytes) -> float | None:
+    """
+    cosine distance between two int8 vectors (see quantize_int8),
+    registered on vector enabled connections as the sql function cos_dist_i8
+    :param a: raw bytes of int8 vector
+    :param b: raw bytes of int8 vector
+    :return: 1 - cosine similarity
+    """
+    if a is None or b is None:
+        return None
+    if _np is not None:
+        # widen to int32 so the dot products can't overflow
+        x = _np.frombuffer(a, dtype=_np.int8).astype(_np.int32)
+        y = _np.frombuffer(b, dtype=_np.int8).astype(_np.int32)
+        norm = math.sqrt(float(x @ x) * float(y @ y))
+        return 1.0 - float(x @ y) / norm if norm else 1.0
+    x = struct.unpack("%sb" % len(a), a)
+    y = struct.unpack("%sb" % len(b), b)
+    norm = math.sqrt(sum(v * v for v in x) * sum(v * v for v in y))
+    return 1.0 - sum(p * q for p, q in zip(x, y)) / norm if norm else 1.0
+
+
 def AND(*params) -> str:
     clause = " AND ".join(params)
     return clause
@@ -38,58 +114,203 @@ def process_dict(d: Dict[Any, Any] | None) -> Tuple[List[Any], List[Any]]:
     :param d: a dictionary
     :return: tuple of key list and values list
     """
-    if not d:
+    if d is None:
         return [], []
-    keys = list(d.keys())
-    vals = list(d.values())
-    return keys, vals
+    # two straight copies, zip(*d.items()) would build a tuple per item.
+    # list(d) walks the keys without making a keys view, an empty dict gives empty lists
+    return list(d), list(d.values())
+
+
+# sqlite column types returned by the detect helpers, interned so comparing them is an identity check
+INTEGER, REAL, BLOB, TEXT = map(sys.intern, ("integer", "real", "blob", "text"))
+
+# files up to this size are read whole and split without the csv module when nothing is quoted
+_FAST_CSV_MAX_SIZE = 64 << 20
+
+# longest digit strings that can still be sqlite integers (at most 2**63 - 1) or sensible reals,
+# larger values are text which also bounds the work done per value
+_MAX_INT = str(2 ** 63 - 1)
+_MAX_INT_LEN = len(_MAX_INT)
+_MAX_REAL_LEN = 64
+
+
+def dict_keys_once(dicts: List[Dict[Any, Any]]) -> Tuple[Any, ...]:
+    """
+    the keys shared by a list of dictionaries, so rows of the same
+    shape only have their values extracted (see dict_values)
+    :param dicts: list of dictionaries
+    :return: tuple of keys in the order of the first dictionary
+    """
+    if not dicts:
+        return ()
+    keys = dicts[0].keys()
+    if any(d.keys() != keys for d in dicts):
+        raise ValueError("all rows must have the same columns")
+    return tuple(keys)
+
+
+def dict_values(d: Dict[Any, Any], keys: Tuple[Any, ...]) -> Tuple[Any, ...]:
+    """
+    the values of a dictionary in the order of the given keys
+    :param d: a dictionary
+    :param keys: keys to look up, e.g. from dict_keys_once
+    :return: tuple of values
+    """
+    return tuple(map(d.__getitem__, keys))
 
 
 def is_int(x: Any):
-    return re.match(r"^[0-9]+$", str(x)) is not None
+    return _is_int_str(x if isinstance(x, str) else str(x))
 
 
 def is_real(x: Any):
-    return re.match(r"^[0-9]+\.[0-9]+$", str(x)) is not None
+    return _is_real_str(x if isinstance(x, str) else str(x))
+
+
+def _is_int_str(s: str) -> bool:
+    # isascii keeps out unicode digits such as '²', which isdigit accepts
+    n = len(s)
+    if n > _MAX_INT_LEN or not (s.isascii() and s.isdigit()):
+        return False
+    # digit strings as long as the maximum compare in numeric order
+    return n < _MAX_INT_LEN or s <= _MAX_INT
+
+
+def _is_real_str(s: str) -> bool:
+    if len(s) > _MAX_REAL_LEN:
+        return False
+    whole, dot, frac = s.partition('.')
+    return bool(dot) and s.isascii() and whole.isdigit() and frac.isdigit()
 
 
 def detect_type_csv(data) -> str:
-    if is_int(data):
-        return "integer"
-    elif is_real(data):
-        return "real"
-    elif isinstance(data, bytes):
-        return "blob"
+    if isinstance(data, bytes):
+        return BLOB
+    try:
+        return _detect_type_csv(data)
+    except TypeError:  # unhashable values skip the cache
+        return _detect_type_csv.__wrapped__(data)
+
+
+# typed so 1 and 1.0 are cached apart
+@functools.lru_cache(maxsize=4096, typed=True)
+def _detect_type_csv(data) -> str:
+    # converted once for both checks
+    s = data if isinstance(data, str) else str(data)
+    if _is_int_str(s):
+        return INTEGER
+    elif _is_real_str(s):
+        return REAL
     else:
-        return "text"
+        return TEXT
+
+
+def infer_column_type(values) -> str:
+    """
+    the narrowest type fitting every value of a column, the scan stops
+    at the first value that only fits text. empty values are skipped
+    :param values: iterable of the column's values
+    :return: sqlite type name
+    """
+    can_be_int = True
+    seen = False
+    for v in values:
+        if v is None or v == "":
+            continue
+        seen = True
+        s = v if isinstance(v, str) else str(v)
+        if can_be_int and _is_int_str(s):
+            continue
+        can_be_int = False
+        if not (_is_real_str(s) or _is_int_str(s)):
+            return BLOB if isinstance(v, bytes) else TEXT
+    if not seen:
+        return TEXT
+    return INTEGER if can_be_int else REAL
+
+
+# exact types of json values, subclasses (e.g. numpy.float64) go through isinstance
+_JSON_TYPES = {int: INTEGER, bool: INTEGER, float: REAL, str: TEXT, bytes: BLOB, type(None): TEXT}
 
 
 def detect_type_json(data) -> str:
+    found = _JSON_TYPES.get(type(data))
+    if found is not None:
+        return found
     if isinstance(data, int):
-        return "integer"
+        return INTEGER
     elif isinstance(data, float):
-        return "real"
+        return REAL
     elif isinstance(data, bytes):
-        return "blob"
+        return BLOB
     else:
-        return "text"
+        return TEXT
 
 
 def extract_filename(fpath) -> str:
-    return os.path.splitext(os.path.basename(fpath))[0]
+    base = os.path.basename(fpath)
+    head, dot, _ = base.rpartition('.')
+    # like splitext, leading dots (.bashrc) don't start an extension
+    return head if dot and head.lstrip('.') else base
 
 
 def read_csv(filepath: str) -> Tuple[List[str], List[str]]:
     """
+    reads a csv file into its header and rows, see iter_csv
+    to process large files without holding every row
+    :param filepath: path to csv file
+    :return: tuple of header list and list of rows
+    """
+    headers, rows = [], []
+    for headers, chunk in iter_csv(filepath):
+        rows.extend(chunk)
+    return headers, rows
+
 
-    :param filepath:
-    :return:
+def read_csv_header(filepath: str) -> List[str]:
+    """
+    reads only the header of a csv file, the rest of the file is never read
+    :param filepath: path to csv file
+    :return: list of column names, empty for an empty file
+    """
+    with open(filepath, "r", encoding="utf-8", errors="replace", newline="") as csv_file:
+        return next(csv.reader(csv_file, delimiter=','), [])
+
+
+def iter_csv(filepath: str, chunk_size: int = 10_000) -> Iterator[Tuple[List[str], List[List[str]]]]:
+    """
+    reads a csv file a chunk of rows at a time, a file with only a header
+    yields one empty chunk and an empty file yields nothing
+    :param filepath: path to csv file
+    :param chunk_size: max number of rows per chunk
+    :return: generator of tuples of header list and list of rows
     """
-    with open(filepath, "r", encoding="utf-8", errors="replace") as csv_file:
-        reader = csv.reader(csv_file, delimiter=',')
-        headers = next(reader)
-        rows = [x for x in reader]
-        return headers, rows
+    # a 1 MiB buffer reads the file in a few large chunks
+    with open(filepath, "rb", buffering=1 << 20) as raw:
+        if os.fstat(raw.fileno()).st_size <= _FAST_CSV_MAX_SIZE:
+            data = raw.read().decode("utf-8", errors="replace")
+            if '"' not in data and '\r' not in data:
+                # nothing is quoted and lines end in \n, so the fields are exactly the
+                # comma separated pieces of each line and str.split does all the work
+                lines = data.split('\n')
+                if lines[-1] == '':
+                    lines.pop()
+                # split lazily so only the chunk being built holds row lists
+                reader = (line.split(',') if line else [] for line in lines)
+            else:
+                reader = csv.reader(io.StringIO(data, newline=""), delimiter=',')
+        else:
+            # newline="" is what the csv module expects
+            reader = csv.reader(io.TextIOWrapper(raw, encoding="utf-8", errors="replace", newline=""), delimiter=',')
+        headers = next(reader, None)
+        if headers is None:
+            return
+        rows = list(itertools.islice(reader, chunk_size))
+        yield headers, rows
+        while len(rows) == chunk_size:
+            rows = list(itertools.islice(reader, chunk_size))
+            if rows:
+                yield headers, rows
 
 
 def safe_name(text: str) -> str:
@@ -1,11 +1,29 @@
+import csv
+import json
+import os
+import tempfile
+import threading
 import unittest
 import sqrl.core as core
 
+try:
+    import pandas as pd
+except ImportError:
+    pd = None
+
 
 class GetTableInfo(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        # the tests only read, so one connection serves the whole class
+        cls.db = core.SQRL("../chinook.db")
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.db.close()
+
     def test_get_table_names(self):
-        db = core.SQRL("../chinook.db")
-        result = db.get_table_names()
+        result = self.db.get_table_names()
         result.sort()
         self.assertEqual(result,
                          ['albums', 'artists',
@@ -23,27 +41,32 @@ class GetTableInfo(unittest.TestCase):
                          )
 
     def test_get_column_names(self):
-        db = core.SQRL("../chinook.db")
-        result = db.get_column_names("albums")
+        result = self.db.get_column_names("albums")
         self.assertIsNotNone(result)
         self.assertEqual(result, ["AlbumId", "Title", "ArtistId"])
 
     def test_get_column_names_nonexistent(self):
-        db = core.SQRL("../chinook.db")
-        result = db.get_column_names("unreal")
+        result = self.db.get_column_names("unreal")
         self.assertFalse(result)
 
 
 class Select(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.db = core.SQRL("../chinook.db")
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.db.close()
+
     def test_normal(self):
         pass
 
     def test_limit_1(self):
-        db = core.SQRL("../chinook.db")
-        result = db.fetch("select name from artists limit 1;")
+        result = self.db.fetch("select name from artists limit 1;")
         self.assertIsInstance(result, str)
         self.assertEqual(result, "AC/DC")
-        result2 = db.fetch("select name from artists limit 10 offset 10;")
+        result2 = self.db.fetch("select name from artists limit 10 offset 10;")
         self.assertEqual(result2, ['Black Label Society', 'Black Sabbath', 'Body Count', 'Bruce Dickinson', 'Buddy Guy',
                                    'Caetano Veloso', 'Chico Buarque', 'Chico Science & Nação Zumbi', 'Cidade Negra',
                                    'Cláudio Zoli'])
@@ -82,6 +105,354 @@ class CreateTableFromCsv(unittest.TestCase):
 
         self.assertEqual(ans, db.select("chinook_artists", return_as_dict=True, limit=5, order_by='Name'))
 
+    def test_short_row(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            filename = os.path.join(tmp, "short.csv")
+            with open(filename, "w") as f:
+                f.write("a,b\n1,2\n3\n")
+            db = core.SQRL()
+            self.assertFalse(db.create_table_from_csv(filename))
+
+    @unittest.skipIf(core._pacsv is None, "pyarrow is not installed")
+    def test_same_table_without_pyarrow(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            filename = os.path.join(tmp, "mixed.csv")
+            with open(filename, "w") as f:
+                f.write('id,big,note\n1,{},"a,b"\n2,3,\n\n3,,"two\nlines"\n'.format("1" * 20))
+            tables = []
+            for pacsv in (core._pacsv, None):
+                saved, core._pacsv = core._pacsv, pacsv
+                try:
+                    with core.SQRL() as db:
+                        self.assertTrue(db.create_table_from_csv(filename))
+                        tables.append((db.fetch("SELECT sql FROM sqlite_master;"),
+                                       db.fetch("SELECT * FROM mixed ORDER BY id;")))
+                finally:
+                    core._pacsv = saved
+            self.assertEqual(tables[0], tables[1])
+            self.assertEqual(tables[0][1][1], (2, "3", ""))
+
+    def test_failure_in_transaction(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            filename = os.path.join(tmp, "short.csv")
+            with open(filename, "w") as f:
+                f.write("a,b\n1,2\n2,b\n3\n")
+            db = core.SQRL()
+            with self.assertRaises(core.sqlite.Error):
+                with db.transaction():
+                    db.create_table_from_csv(filename)
+            self.assertFalse(db.table_exists("short"))
+
+
+class InsertMany(unittest.TestCase):
+    def test_normal(self):
+        db = core.SQRL()
+        self.assertTrue(db.execute("CREATE TABLE items (id integer, name text)"))
+        rows = [{"id": i, "name": f"item{i}"} for i in range(100)]
+        self.assertTrue(db.insert_many("items", rows))
+        self.assertEqual(db.count("items"), 100)
+        self.assertEqual(db.select("items", return_as_dict=True, limit=1, order_by="id", asc=False),
+                         {"id": 99, "name": "item99"})
+
+    def test_mixed_columns(self):
+        db = core.SQRL()
+        self.assertTrue(db.execute("CREATE TABLE items (id integer, name text)"))
+        with self.assertRaises(ValueError):
+            db.insert_many("items", [{"id": 1, "name": "a"}, {"id": 2}])
+
+    def test_failure_rolls_back(self):
+        db = core.SQRL()
+        self.assertTrue(db.execute("CREATE TABLE items (id integer primary key, name text)"))
+        self.assertFalse(db.insert_many("items", [{"id": 1, "name": "a"}, {"id": 1, "name": "b"}]))
+        self.assertEqual(db.count("items"), 0)
+
+
+class Transaction(unittest.TestCase):
+    def test_context_manager(self):
+        with core.SQRL() as db:
+            self.assertTrue(db.execute("CREATE TABLE items (id integer primary key, name text)"))
+            self.assertTrue(db.insert("items", {"id": 1, "name": "a"}))
+        with self.assertRaises(core.sqlite.ProgrammingError):
+            db.con.execute("SELECT 1;")
+
+    def test_commit(self):
+        db = core.SQRL()
+        self.assertTrue(db.execute("CREATE TABLE items (id integer primary key, name text)"))
+        with db.transaction():
+            db.insert("items", {"id": 1, "name": "a"})
+            db.insert("items", {"id": 2, "name": "b"})
+        self.assertEqual(db.count("items"), 2)
+
+    def test_rollback(self):
+        db = core.SQRL()
+        self.assertTrue(db.execute("CREATE TABLE items (id integer primary key, name text)"))
+        with self.assertRaises(core.sqlite.IntegrityError):
+            with db.transaction():
+                db.insert("items", {"id": 1, "name": "a"})
+                db.insert("items", {"id": 1, "name": "b"})
+        self.assertEqual(db.count("items"), 0)
+        self.assertTrue(db.insert("items", {"id": 1, "name": "a"}))
+
+    def test_script_rolled_back(self):
+        db = core.SQRL()
+        self.assertTrue(db.execute("CREATE TABLE items (id integer primary key, name text)"))
+        with self.assertRaises(ValueError):
+            with db.transaction():
+                db.insert("items", {"id": 1, "name": "a"})
+                self.assertTrue(db.executescript("INSERT INTO items VALUES (2, 'b;c'); INSERT INTO items VALUES (3, 'd');"))
+                self.assertEqual(db.count("items"), 3)
+                raise ValueError
+        self.assertEqual(db.count("items"), 0)
+
+
+class ReadConnection(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.file = os.path.join(self.dir.name, "items.db")
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test_last_insert_rowid(self):
+        with core.SQRL(self.file) as db:
+            self.assertTrue(db.execute("CREATE TABLE items (id integer primary key, name text)"))
+            self.assertTrue(db.insert("items", {"id": 7, "name": "a"}))
+            self.assertEqual(db.fetch("SELECT last_insert_rowid();", one=True), 7)
+            self.assertEqual(db.fetch("SELECT changes();", one=True), 1)
+
+    def test_temp_column_keeps_reader(self):
+        with core.SQRL(self.file) as db:
+            self.assertTrue(db.execute("CREATE TABLE readings (id integer, temp real)"))
+            self.assertTrue(db.insert("readings", {"id": 1, "temp": 21.5}))
+            self.assertIsNotNone(db._owner.reader)
+            self.assertTrue(db.execute("CREATE TEMP TABLE scratch (id integer)"))
+            self.assertIsNone(db._owner.reader)
+            self.assertEqual(db.fetch("SELECT count(*) FROM scratch;", one=True), 0)
+
+    def test_attached(self):
+        with core.SQRL(self.file) as db:
+            self.assertTrue(db.execute("ATTACH ':memory:' AS aux;"))
+            self.assertTrue(db.execute("CREATE TABLE aux.z (id integer);"))
+            self.assertTrue(db.execute("INSERT INTO aux.z VALUES (1);"))
+            self.assertEqual(db.fetch("SELECT id FROM aux.z;"), [1])
+
+
+def embed_text(text):
+    # deterministic two dimensional embedding for the vector tests
+    return [float(len(text)), float(sum(map(ord, text)) % 7 + 1)]
+
+
+def in_thread(fn):
+    # runs fn on another thread and returns its result or raises its exception
+    out = {}
+
+    def run():
+        try:
+            out["result"] = fn()
+        except BaseException as e:
+            out["error"] = e
+
+    t = threading.Thread(target=run)
+    t.start()
+    t.join()
+    if "error" in out:
+        raise out["error"]
+    return out["result"]
+
+
+class Threads(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.file = os.path.join(self.dir.name, "items.db")
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test_read_write(self):
+        with core.SQRL(self.file) as db:
+            self.assertTrue(db.execute("CREATE TABLE items (id integer primary key, worker integer)"))
+            errors = []
+
+            def work(worker):
+                try:
+                    for i in range(50):
+                        self.assertTrue(db.insert("items", {"id": worker * 100 + i, "worker": worker}))
+                    # every thread reads its own writes back
+                    self.assertEqual(db.fetch("SELECT count(*) FROM items WHERE worker = ?;", worker, one=True), 50)
+                except BaseException as e:
+                    errors.append(e)
+
+            threads = [threading.Thread(target=work, args=(w,)) for w in range(4)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            self.assertEqual(errors, [])
+            self.assertEqual(db.count("items"), 200)
+            self.assertIsNot(in_thread(db._conn), db.con)
+
+
+class Export(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.cwd = os.getcwd()
+        os.chdir(self.dir.name)
+        self.db = core.SQRL("shop.db")
+        self.assertTrue(self.db.execute("CREATE TABLE items (id integer primary key, name text)"))
+        self.assertTrue(self.db.execute("CREATE TABLE prices (id integer primary key, price real)"))
+        self.assertTrue(self.db.insert_many("items", [{"id": i, "name": f"item{i}"} for i in range(3)]))
+        self.assertTrue(self.db.insert_many("prices", [{"id": i, "price": i / 2} for i in range(3)]))
+
+    def tearDown(self):
+        self.db.close()
+        os.chdir(self.cwd)
+        self.dir.cleanup()
+
+    def test_export_to_csv(self):
+        self.db.export_to_csv()
+        for table in ("items", "prices"):
+            with open(f"shop-{table}.csv", newline="") as f:
+                rows = list(csv.reader(f))
+            self.assertEqual(rows[0], self.db.get_column_names(table))
+            self.assertEqual(rows[1:], [[str(v) for v in row] for row in self.db.select(table, order_by="id")])
+
+    def test_to_json(self):
+        self.assertTrue(self.db.to_json("items", "items.json"))
+        with open("items.json") as f:
+            self.assertEqual(json.load(f), self.db.select("items", return_as_dict=True, order_by="id"))
+        self.assertFalse(self.db.to_json("missing", "missing.json"))
+
+
+@unittest.skipIf(pd is None, "pandas is not installed")
+class FromDataFrame(unittest.TestCase):
+    def test_column_types(self):
+        df = pd.DataFrame(
+            {"n": [1, 2, 3], "x": [0.5, None, 1.5], "s": [None, "b", "c"], "e": [None, None, None]},
+            index=[0, 1, 1]
+        )
+        db = core.SQRL()
+        self.assertTrue(db.from_df(df, "frame"))
+        self.assertEqual(db.fetch("SELECT type FROM pragma_table_info('frame') ORDER BY cid;"),
+                         ["INTEGER", "REAL", "TEXT", "TEXT"])
+        self.assertEqual(db.count("frame"), 3)
+
+
+class FlatIndex(unittest.TestCase):
+    def test_nearest(self):
+        db = core.SQRL(enable_vectors=True, embedding_fn=embed_text)
+        self.assertTrue(db.create_embedding_db("s", dim=2, index="flat"))
+        self.assertTrue(db.add_embeddings("s", ["a", "bbbbbbbb", "cc"]))
+        nearest = db.k_nearest_embeddings("s", "bbbbbbbb", k=2)
+        self.assertEqual(len(nearest), 2)
+        self.assertEqual(nearest[0][1], "bbbbbbbb")
+        self.assertAlmostEqual(nearest[0][2], 0.0, places=5)
+        self.assertLessEqual(nearest[0][2], nearest[1][2])
+
+    def test_int8(self):
+        for index in ("flat", "vec0"):
+            db = core.SQRL(enable_vectors=True, embedding_fn=embed_text)
+            if index == "vec0" and not db._vec0_enabled:
+                continue  # sqlite-vec can't be loaded by this python
+            with self.subTest(index=index):
+                self.assertTrue(db.create_embedding_db("s", dim=2, index=index, quantization="int8"))
+                self.assertEqual(db._vector_index("s"), (index, True))
+                self.assertTrue(db.add_embeddings("s", ["a", "bbbbbbbb", "cc"]))
+                nearest = db.k_nearest_embeddings("s", "bbbbbbbb", k=3)
+                self.assertEqual(nearest[0][1], "bbbbbbbb")
+                self.assertAlmostEqual(nearest[0][2], 0.0, places=2)
+                self.assertEqual(len(nearest), 3)
+
+
+class EmbeddingCache(unittest.TestCase):
+    def test_large_texts_keyed_on_digest(self):
+        calls = []
+
+        def embed(text):
+            calls.append(text)
+            return embed_text(text)
+
+        db = core.SQRL(enable_vectors=True, embedding_fn=embed)
+        self.assertTrue(db.create_embedding_db("s", dim=2, index="flat"))
+        document = "x" * 10_000
+        self.assertTrue(db.add_embeddings("s", ["a", document]))
+        self.assertEqual(db.k_nearest_embeddings("s", document, k=1)[0][1], document)
+        self.assertEqual(len(calls), 2)
+        self.assertNotIn(document, db._embed_cache)
+
+
+@unittest.skipIf(core.vectorlite_py is None, "vectorlite is not installed")
+class HnswThreads(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.file = os.path.join(self.dir.name, "vectors.db")
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test_shared_index(self):
+        with core.SQRL(self.file, enable_vectors=True, embedding_fn=embed_text, check_same_thread=False) as db:
+            self.assertTrue(db.create_embedding_db("s", dim=2, index="hnsw"))
+            self.assertTrue(db.add_embeddings("s", ["a", "bb", "ccc"]))
+            self.assertEqual(len(in_thread(lambda: db.k_nearest_embeddings("s", "bb", k=3))), 3)
+            self.assertTrue(in_thread(lambda: db.add_embedding("s", "zzzz")))
+            self.assertEqual(len(db.k_nearest_embeddings("s", "bb", k=10)), 4)
+        with core.SQRL(self.file, enable_vectors=True, embedding_fn=embed_text) as db:
+            self.assertEqual(db.count("s_content"), 4)
+            self.assertEqual(len(db.k_nearest_embeddings("s", "bb", k=10)), 4)
+
+    def test_refused_from_other_thread(self):
+        with core.SQRL(self.file, enable_vectors=True, embedding_fn=embed_text) as db:
+            self.assertTrue(db.create_embedding_db("s", dim=2, index="hnsw"))
+            self.assertTrue(db.add_embedding("s", "a"))
+            with self.assertRaises(RuntimeError):
+                in_thread(lambda: db.k_nearest_embeddings("s", "a", k=1))
+
+
+class CompiledStatements(unittest.TestCase):
+    def test_insert_and_update(self):
+        db = core.SQRL()
+        self.assertTrue(db.execute("CREATE TABLE items (id integer primary key, name text)"))
+        insert = db.compile_insert("items", ["id", "name"])
+        for i in range(10):
+            self.assertTrue(insert((i, f"item{i}")))
+        self.assertFalse(insert((0, "duplicate")))
+        update = db.compile_update("items", ["name"], where="id = ?")
+        self.assertTrue(update(("renamed", 3)))
+        self.assertEqual(db.count("items"), 10)
+        self.assertEqual(db.fetch("SELECT name FROM items WHERE id = ?", 3, one=True), "renamed")
+
+
+class QueryCache(unittest.TestCase):
+    def test_invalidated_on_write(self):
+        db = core.SQRL(cache_ttl=60)
+        self.assertTrue(db.execute("CREATE TABLE items (id integer, name text)"))
+        self.assertEqual(db.count("items"), 0)
+        self.assertTrue(db.insert("items", {"id": 1, "name": "a"}))
+        self.assertEqual(db.count("items"), 1)
+
+    def test_hit(self):
+        db = core.SQRL(cache_ttl=60)
+        self.assertTrue(db.execute("CREATE TABLE items (id integer, name text)"))
+        self.assertEqual(db.count("items"), 0)
+        # bypass the instance so the cache isn't cleared
+        db.con.execute("INSERT INTO items VALUES (1, 'a')")
+        self.assertEqual(db.count("items"), 0)
+
+    def test_result_copied(self):
+        db = core.SQRL(cache_ttl=60)
+        self.assertTrue(db.execute("CREATE TABLE b (id integer)"))
+        self.assertTrue(db.execute("CREATE TABLE a (id integer)"))
+        result = db.fetch("SELECT name FROM sqlite_master ORDER BY name DESC;")
+        result.sort()
+        self.assertEqual(db.fetch("SELECT name FROM sqlite_master ORDER BY name DESC;"), ["b", "a"])
+
+    def test_expired(self):
+        db = core.SQRL(cache_ttl=0)
+        self.assertTrue(db.execute("CREATE TABLE items (id integer, name text)"))
+        self.assertEqual(db.count("items"), 0)
+        db.con.execute("INSERT INTO items VALUES (1, 'a')")
+        self.assertEqual(db.count("items"), 1)
+
 
 if __name__ == '__main__':
     unittest.main()
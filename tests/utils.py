@@ -1,7 +1,38 @@
+import struct
 import unittest
 import sqrl.utils as utils
 
 
+class TestSerialize(unittest.TestCase):
+    def test_serialize(self):
+        vector = [0.5, -1.25, 3.0]
+        self.assertEqual(utils.serialize(vector), struct.pack("3f", *vector))
+        self.assertEqual(utils.serialize([]), b"")
+
+    def test_cosine_distance(self):
+        a, b = utils.serialize([1.0, 0.0]), utils.serialize([0.0, 2.0])
+        self.assertAlmostEqual(utils.cosine_distance(a, b), 1.0)
+        self.assertAlmostEqual(utils.cosine_distance(a, utils.serialize([3.0, 0.0])), 0.0)
+        self.assertIsNone(utils.cosine_distance(a, None))
+
+    def test_quantize_int8(self):
+        q = utils.quantize_int8([0.5, -1.0, 0.0])
+        self.assertEqual(struct.unpack("3b", q), (64, -127, 0))
+        self.assertEqual(utils.quantize_int8(utils.serialize([0.5, -1.0, 0.0])), q)
+        self.assertAlmostEqual(utils.cosine_distance_int8(q, utils.quantize_int8([1.0, -2.0, 0.0])), 0.0, places=4)
+
+
+class TestDictHelpers(unittest.TestCase):
+    def test_dict_keys_once(self):
+        rows = [{"a": 1, "b": 2}, {"a": 3, "b": 4}]
+        keys = utils.dict_keys_once(rows)
+        self.assertEqual(keys, ("a", "b"))
+        self.assertEqual([utils.dict_values(row, keys) for row in rows], [(1, 2), (3, 4)])
+        self.assertEqual(utils.dict_keys_once([]), ())
+        with self.assertRaises(ValueError):
+            utils.dict_keys_once([{"a": 1}, {"b": 2}])
+
+
 class TestExtractFilename(unittest.TestCase):
     def test_extract_filename(self):
         self.assertEqual(utils.extract_filename("hello/world.txt"), "world")
@@ -19,6 +50,26 @@ class TestDetectType(unittest.TestCase):
         self.assertEqual(utils.detect_type_csv(b"hello world"), "blob")
         self.assertEqual(utils.detect_type_csv("hello world"), "text")
 
+    def test_is_int_is_real(self):
+        self.assertTrue(utils.is_int("123"))
+        self.assertFalse(utils.is_int(""))
+        self.assertFalse(utils.is_int("²"))
+        self.assertFalse(utils.is_int("-1"))
+        self.assertTrue(utils.is_int("9223372036854775807"))
+        self.assertFalse(utils.is_int("9223372036854775808"))
+        self.assertFalse(utils.is_int("9" * 19))
+        self.assertFalse(utils.is_int("9" * 20))
+        self.assertTrue(utils.is_real("1.5"))
+        self.assertFalse(utils.is_real("1."))
+        self.assertFalse(utils.is_real(".5"))
+        self.assertFalse(utils.is_real("1.2.3"))
+
+    def test_infer_column_type(self):
+        self.assertEqual(utils.infer_column_type(["1", "", "2"]), "integer")
+        self.assertEqual(utils.infer_column_type(["1", "2.5"]), "real")
+        self.assertEqual(utils.infer_column_type(["1", "x", "2"]), "text")
+        self.assertEqual(utils.infer_column_type(["", ""]), "text")
+
     def test_detect_type_json(self):
         self.assertEqual(utils.detect_type_json(1), "integer")
         self.assertEqual(utils.detect_type_json(1.0), "real")
@@ -36,6 +87,14 @@ class TestReadCsv(unittest.TestCase):
         self.assertEqual(headers, ["name", "seq"])
         self.assertEqual(rows[0], ["artist", '2'])
 
+    def test_header(self):
+        self.assertEqual(utils.read_csv_header("memory-sqlite_sequence.csv"), ["name", "seq"])
+
+    def test_iter_csv(self):
+        chunks = list(utils.iter_csv("memory-sqlite_sequence.csv", chunk_size=1))
+        self.assertEqual(chunks[0], (["name", "seq"], [["artist", '2']]))
+        self.assertTrue(all(len(rows) == 1 for _, rows in chunks))
+
 
 if __name__ == '__main__':
     unittest.main()